@@ -0,0 +1,14 @@
+import os
+
+# Запуск: gunicorn main:app
+bind = os.getenv('BIND', '0.0.0.0:5000')
+
+# gevent-воркеры: ожидание ответа OpenWeatherMap не блокирует воркер,
+# промахи кэша от разных клиентов обрабатываются параллельно
+worker_class = 'gevent'
+# Один процесс: конкурентность дает gevent. Лимиты Flask-Limiter хранятся в памяти
+# процесса, а лог пишет один RotatingFileHandler, поэтому при WORKERS > 1 лимиты
+# становятся на каждый воркер, а ротация лога из нескольких процессов теряет записи
+workers = int(os.getenv('WORKERS', 1))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+timeout = 30
@@ -1,28 +1,100 @@
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 from datetime import datetime
 import time
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import math
+import numpy as np
 import os
 from dotenv import load_dotenv
-import json
 import os
+import platform
+import tempfile
 from pathlib import Path
 from datetime import datetime, timedelta
-import hashlib
+import threading
+import itertools
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
+# Под PyPy (`pypy3 main.py`) используется встроенный json: orjson там недоступен,
+# а JIT PyPy сам ускоряет расчеты без numba
+USE_ORJSON = platform.python_implementation() != 'PyPy'
+
+if not USE_ORJSON:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+else:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+
+try:
+    from numba import njit
+except ImportError:  # numba не установлена - считаем на чистом Python / NumPy
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 
 # Загрузка переменных окружения
 load_dotenv()
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: используется в jsonify и request.get_json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+
 app = Flask(__name__)
+if USE_ORJSON:
+    app.json = OrjsonProvider(app)
 # Конфигурация кэша
 CACHE_DIR = Path('weather_cache')
 CACHE_TTL = timedelta(hours=1)  # Время жизни кэша
+CACHE_TTL_SECONDS = CACHE_TTL.total_seconds()
+CACHE_TTL_HOURS = CACHE_TTL_SECONDS / 3600
+MAX_CACHE_SIZE = 1000  # Максимальное число записей в кэше (в памяти и на диске)
+CACHE_CLEAN_EVERY = 100  # Проверять размер кэш-директории раз в N записей
+CACHE_TMP_MAX_AGE = 60  # Через сколько секунд недописанный .tmp-файл считается брошенным
+
+# Права файлов кэша как у обычного open(): 0666 с учетом umask процесса
+# (mkstemp создает файлы с правами 0600)
+_umask = os.umask(0)
+os.umask(_umask)
+CACHE_FILE_MODE = 0o666 & ~_umask
+
+# Кэш в памяти перед файловым кэшем:
+# ключ кэша -> (время истечения по time.monotonic(), данные о погоде)
+_mem_cache = OrderedDict()
+_mem_cache_lock = threading.RLock()
+_cache_write_counter = itertools.count(1)
+# Очередь (файл, данные) для фонового потока записи кэша на диск
+_cache_write_queue = queue.Queue()
 
 
 def init_cache():
@@ -31,29 +103,65 @@ def init_cache():
     app.logger.info(f"Cache directory initialized at {CACHE_DIR.absolute()}")
 
 
+@lru_cache(maxsize=4096)
 def get_cache_key(lat: float, lon: float) -> str:
-    """Генерация ключа кэша на основе координат"""
-    key = f"{round(lat, 4)}_{round(lon, 4)}"
-    return hashlib.md5(key.encode()).hexdigest()
+    """Генерация ключа кэша (имени файла) на основе координат"""
+    return f"{round(lat, 4)}_{round(lon, 4)}"
+
+
+def _mem_cache_get(key: str):
+    """Получить данные из кэша в памяти или None, если записи нет или она устарела"""
+    with _mem_cache_lock:
+        entry = _mem_cache.get(key)
+        if entry is None:
+            return None
+
+        expires_at, weather_data = entry
+        if time.monotonic() >= expires_at:
+            del _mem_cache[key]
+            return None
+
+        _mem_cache.move_to_end(key)
+        return weather_data
+
+
+def _mem_cache_set(key: str, weather_data: dict, expires_at: float):
+    """Положить данные в кэш в памяти, вытесняя самые давние записи"""
+    with _mem_cache_lock:
+        _mem_cache[key] = (expires_at, weather_data)
+        _mem_cache.move_to_end(key)
+        while len(_mem_cache) > MAX_CACHE_SIZE:
+            _mem_cache.popitem(last=False)
 
 
 def get_cached_weather(lat: float, lon: float) -> dict:
     """Получить данные из кэша"""
-    cache_file = CACHE_DIR / f"{get_cache_key(lat, lon)}.json"
+    # Один ключ для памяти и диска: записи обоих уровней всегда совпадают
+    key = get_cache_key(lat, lon)
+
+    weather_data = _mem_cache_get(key)
+    if weather_data is not None:
+        return weather_data
+
+    cache_file = CACHE_DIR / f"{key}.json"
 
-    if not cache_file.exists():
+    try:
+        mtime = os.stat(cache_file).st_mtime
+    except FileNotFoundError:
         return None
 
     try:
-        with open(cache_file, 'r') as f:
-            data = json.load(f)
+        age = time.time() - mtime
+        if age >= CACHE_TTL_SECONDS:
+            app.logger.debug("Cache expired for %s", cache_file.name)
+            return None
 
-        cache_time = datetime.fromisoformat(data['timestamp'])
-        if datetime.now() - cache_time < CACHE_TTL:
-            app.logger.debug(f"Cache hit for {cache_file.name}")
-            return data['weather_data']
+        with open(cache_file, 'rb') as f:
+            data = json_loads(f.read())
 
-        app.logger.debug(f"Cache expired for {cache_file.name}")
+        app.logger.debug("Cache hit for %s", cache_file.name)
+        _mem_cache_set(key, data['weather_data'], time.monotonic() + CACHE_TTL_SECONDS - age)
+        return data['weather_data']
     except Exception as e:
         app.logger.error(f"Error reading cache file {cache_file}: {e}")
 
@@ -61,43 +169,88 @@ def get_cached_weather(lat: float, lon: float) -> dict:
 
 
 def set_cached_weather(lat: float, lon: float, weather_data: dict):
-    """Сохранить данные в кэш"""
-    cache_file = CACHE_DIR / f"{get_cache_key(lat, lon)}.json"
+    """Сохранить данные в кэш: в память сразу, на диск в фоне"""
+    key = get_cache_key(lat, lon)
+    _mem_cache_set(key, weather_data, time.monotonic() + CACHE_TTL_SECONDS)
 
+    cache_file = CACHE_DIR / f"{key}.json"
+
+    # Свежесть файла определяется по его mtime, поэтому время в файле не хранится
     data = {
-        'timestamp': datetime.now().isoformat(),
         'coordinates': {'lat': lat, 'lon': lon},
         'weather_data': weather_data
     }
 
+    _cache_write_queue.put((cache_file, data))
+
+
+def _cache_writer():
+    """Фоновый поток: последовательно записывает файлы кэша из очереди"""
+    while True:
+        cache_file, data = _cache_write_queue.get()
+        _write_cache_file(cache_file, data)
+
+
+def _write_cache_file(cache_file: Path, data: dict):
+    """Записать файл кэша на диск атомарно: через временный файл и os.replace"""
+    tmp_path = None
     try:
-        with open(cache_file, 'w') as f:
-            json.dump(data, f, indent=2)
-        app.logger.debug(f"Weather data cached to {cache_file.name}")
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json_dumps(data))
+        os.chmod(tmp_path, CACHE_FILE_MODE)
+        # Читатели видят либо старый, либо полностью записанный новый файл
+        os.replace(tmp_path, cache_file)
+        app.logger.debug("Weather data cached to %s", cache_file.name)
     except Exception as e:
         app.logger.error(f"Error writing cache file {cache_file}: {e}")
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return
 
+    if next(_cache_write_counter) % CACHE_CLEAN_EVERY == 0:
+        clean_cache()
 
-def clean_expired_cache():
-    """Очистка просроченного кэша"""
-    now = datetime.now()
-    deleted = 0
 
-    for cache_file in CACHE_DIR.glob('*.json'):
-        try:
-            with open(cache_file, 'r') as f:
-                data = json.load(f)
+def clean_cache():
+    """
+    Удаление самых старых файлов кэша сверх MAX_CACHE_SIZE
+    и брошенных временных файлов от прерванной записи
+    """
+    # Размер считается по директории, а не по состоянию процесса: так лимит
+    # общий для всех воркеров gunicorn. Один проход scandir, stat из DirEntry
+    entries, stale = [], []
+    now = time.time()
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for e in it:
+                if e.name.endswith('.json'):
+                    entries.append((e.stat().st_mtime, e.path))
+                elif e.name.endswith('.tmp') and now - e.stat().st_mtime > CACHE_TMP_MAX_AGE:
+                    stale.append(e.path)
+    except Exception as e:
+        app.logger.error(f"Error scanning cache directory {CACHE_DIR}: {e}")
+        return
 
-            cache_time = datetime.fromisoformat(data['timestamp'])
-            if now - cache_time >= CACHE_TTL:
-                cache_file.unlink()
-                deleted += 1
-        except Exception as e:
-            app.logger.error(f"Error cleaning cache file {cache_file}: {e}")
+    if len(entries) > MAX_CACHE_SIZE:
+        entries.sort()
+        stale.extend(path for _, path in entries[:len(entries) - MAX_CACHE_SIZE])
+
+    deleted = 0
+    for path in stale:
+        try:
+            os.unlink(path)
+            deleted += 1
+        except FileNotFoundError:
             continue
+        except Exception as e:
+            app.logger.error(f"Error cleaning cache file {path}: {e}")
 
     if deleted:
-        app.logger.info(f"Cleaned {deleted} expired cache files")
+        app.logger.info(f"Cleaned {deleted} old cache files")
 
 # Конфигурация логирования
 def setup_logging():
@@ -110,11 +263,19 @@ def setup_logging():
     handler = RotatingFileHandler(
         log_file, maxBytes=1000000, backupCount=5
     )
-    handler.setFormatter(logging.Formatter(
+    formatter = logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    ))
-
-    app.logger.addHandler(handler)
+    )
+    formatter.default_msec_format = None  # Время без миллисекунд
+    handler.setFormatter(formatter)
+
+    # Запись в файл идет в фоновом потоке, запрос только кладет запись в очередь
+    log_queue = queue.Queue(-1)
+    app.logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    # При завершении дописываем оставшиеся в очереди записи
+    atexit.register(listener.stop)
     app.logger.setLevel(logging.INFO)
 
 
@@ -122,6 +283,21 @@ def setup_logging():
 # Конфигурация API
 OWM_API_KEY = os.getenv('OWM_API_KEY')
 OWM_API_URL = "https://api.openweathermap.org/data/2.5/weather"
+# Маскированный ключ для логов вычисляется один раз, а не на каждый запрос
+OWM_API_KEY_MASKED = OWM_API_KEY[:4] + '...' + OWM_API_KEY[-4:] if OWM_API_KEY else None
+# Максимум точек в одном пакетном запросе. Лимитер списывает по единице за точку,
+# поэтому размер пакета не может превышать минутный лимит эндпоинта
+MAX_BATCH_SIZE = 10
+
+# Общая HTTP-сессия: keep-alive соединения к OWM переиспользуются между запросами
+http_session = requests.Session()
+# Все запросы идут на один хост, поэтому важен размер пула, а не число пулов:
+# под gevent-воркером одновременных промахов кэша может быть десятки
+http_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1)
+))
 
 limiter = Limiter(
     app=app,
@@ -129,180 +305,271 @@ limiter = Limiter(
     default_limits=["2000 per day", "100 per hour"]  # Лимиты по умолчанию
 )
 
-def log_owm_interaction(url, params, response, duration):
+def log_owm_interaction(url, params, status_code, parsed, duration):
     """Логирование деталей взаимодействия с OpenWeatherMap API"""
     log_data = {
         'timestamp': datetime.utcnow().isoformat(),
         'api_endpoint': url,
         'request_params': params,
-        'response_status': response.status_code,
-        'response_data': response.json() if response.status_code == 200 else None,
+        'response_status': status_code,
+        'response_data': parsed,
         'processing_time_sec': duration,
-        'api_key_used': OWM_API_KEY[:4] + '...' + OWM_API_KEY[-4:] if OWM_API_KEY else None
+        'api_key_used': OWM_API_KEY_MASKED
     }
 
     app.logger.info("OpenWeatherMap API Interaction", extra={'data': log_data})
 
 
-def calculate_absolute_humidity(temp_c, relative_humidity):
-    """Рассчитывает абсолютную влажность (г/м³)"""
-    try:
-        if temp_c is None or relative_humidity is None:
-            app.logger.warning("Invalid input for humidity calculation")
-            return None
+# mw * 100 / R: молярная масса воды (г/моль), перевод гПа в Па и
+# универсальная газовая постоянная (Дж/(моль·K)), свернутые в одну константу
+_K = 18.01528 * 100 / 8.314462618
 
-        R = 8.314462618
-        mw = 18.01528
 
-        es = 6.112 * math.exp((17.67 * temp_c) / (temp_c + 243.5))
-        e = es * (relative_humidity / 100.0)
-        temp_k = temp_c + 273.15
-        absolute_humidity = (e * mw) / (R * temp_k) * 100
+@njit(cache=True, fastmath=True)
+def _es(temp_c):
+    """Давление насыщенного пара (гПа) для температуры в °C"""
+    return 6.112 * math.exp((17.67 * temp_c) / (temp_c + 243.5))
 
-        app.logger.debug(
-            f"Calculated absolute humidity: {absolute_humidity:.2f} g/m³ from "
-            f"temp: {temp_c}°C, RH: {relative_humidity}%"
-        )
 
-        return round(absolute_humidity, 2)
-    except Exception as e:
-        app.logger.error(f"Error in humidity calculation: {str(e)}")
-        return None
+@lru_cache(maxsize=512)
+def saturation_vapor_pressure(temp_c: float) -> float:
+    """Давление насыщенного пара с кэшем: температуры от OWM часто повторяются"""
+    return _es(temp_c)
+
+
+@njit(cache=True, fastmath=True)
+def _abs_hum(es, temp_c, relative_humidity):
+    """Численное ядро расчета абсолютной влажности (г/м³)"""
+    e = es * (relative_humidity / 100.0)
+    temp_k = temp_c + 273.15
+    return e * _K / temp_k
+
+
+@njit(cache=True, fastmath=True)
+def _room_rh(es_room, absolute_humidity, room_temp_c):
+    """Численное ядро расчета относительной влажности (%) по абсолютной"""
+    # Обратное преобразование: из абсолютной влажности в парциальное давление (гПа)
+    temp_k = room_temp_c + 273.15
+    e_room = absolute_humidity * temp_k / _K
+
+    # Расчет относительной влажности для комнатной температуры
+    return (e_room / es_room) * 100
+
+
+@njit(cache=True, fastmath=True)
+def _ah_kernel(temp_c, relative_humidity):
+    """Векторный расчет абсолютной влажности (г/м³) для массивов температур и RH"""
+    es = 6.112 * np.exp((17.67 * temp_c) / (temp_c + 243.5))
+    return es * (relative_humidity / 100.0) * _K / (temp_c + 273.15)
 
 
-def calculate_relative_humidity_for_room(absolute_humidity, room_temp_c):
+@njit(cache=True, fastmath=True)
+def _rh_room_kernel(absolute_humidity, room_temp_c):
+    """Векторный расчет относительной влажности (%) для массивов AH и комнатных температур"""
+    es_room = 6.112 * np.exp((17.67 * room_temp_c) / (room_temp_c + 243.5))
+    e_room = absolute_humidity * (room_temp_c + 273.15) / _K
+    return (e_room / es_room) * 100
+
+
+# Прогрев JIT, чтобы компиляция не попадала на первый запрос
+_abs_hum(_es(20.0), 20.0, 50.0)
+_room_rh(_es(22.0), 8.6, 22.0)
+_rh_room_kernel(_ah_kernel(np.array([20.0, 25.0]), np.array([50.0, 60.0])),
+                np.array([22.0, 22.0]))
+
+
+def compute_humidity(temp_c, relative_humidity, room_temp_c):
     """
-    Рассчитывает относительную влажность для комнатной температуры
-    на основе абсолютной влажности
+    Рассчитывает абсолютную влажность на улице и относительную влажность
+    в помещении при комнатной температуре
 
     Параметры:
-        absolute_humidity - абсолютная влажность в г/м³
+        temp_c - температура на улице в °C
+        relative_humidity - относительная влажность на улице в %
         room_temp_c - комнатная температура в °C
 
     Возвращает:
-        relative_humidity - относительная влажность в %
+        (absolute_humidity, relative_humidity_room) - влажность в г/м³ и в %,
+        или None при ошибке расчета
     """
     try:
-        if absolute_humidity is None or room_temp_c is None:
-            app.logger.warning("Invalid input for room humidity calculation")
+        if temp_c is None or relative_humidity is None or room_temp_c is None:
+            app.logger.warning("Invalid input for humidity calculation")
             return None
 
-        # Константы для расчета
-        R = 8.314462618  # Универсальная газовая постоянная (Дж/(моль·K))
-        mw = 18.01528  # Молярная масса воды (г/моль)
+        temp_c = float(temp_c)
+        room_temp_c = float(room_temp_c)
 
-        # Расчет давления насыщенного пара для комнатной температуры
-        es_room = 6.112 * math.exp((17.67 * room_temp_c) / (room_temp_c + 243.5))  # в гПа
+        absolute_humidity = round(_abs_hum(
+            saturation_vapor_pressure(temp_c), temp_c, float(relative_humidity)
+        ), 2)
 
-        # Обратное преобразование: из абсолютной влажности в парциальное давление
-        temp_k = room_temp_c + 273.15
-        e_room = (absolute_humidity * R * temp_k) / (mw * 100)  # *100 для перевода Па в гПа
+        # Абсолютная влажность в помещении та же; RH считается от округленного значения,
+        # которое возвращается клиенту
+        relative_humidity_room = round(_room_rh(
+            saturation_vapor_pressure(room_temp_c), absolute_humidity, room_temp_c
+        ), 1)
 
-        # Расчет относительной влажности для комнатной температуры
-        relative_humidity_room = (e_room / es_room) * 100
-
-        app.logger.debug(
-            f"Calculated room RH: {relative_humidity_room:.1f}% at {room_temp_c}°C "
-            f"from AH: {absolute_humidity}g/m³"
-        )
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug(
+                f"Calculated absolute humidity: {absolute_humidity:.2f} g/m³ from "
+                f"temp: {temp_c}°C, RH: {relative_humidity}%; "
+                f"room RH: {relative_humidity_room:.1f}% at {room_temp_c}°C"
+            )
 
-        return round(relative_humidity_room, 1)
+        return absolute_humidity, relative_humidity_room
     except Exception as e:
-        app.logger.error(f"Error in room humidity calculation: {str(e)}")
+        app.logger.error(f"Error in humidity calculation: {str(e)}")
         return None
 
 
+class WeatherAPIError(Exception):
+    """Ошибка ответа OpenWeatherMap"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def fetch_weather(lat: float, lon: float, request_id: str):
+    """
+    Получает данные о погоде из кэша или от OpenWeatherMap
+
+    Возвращает:
+        (data, from_cache) - данные о погоде и признак попадания в кэш
+
+    Исключения:
+        WeatherAPIError - OpenWeatherMap недоступен, ответил ошибкой
+        или некорректными данными
+    """
+    cached_data = get_cached_weather(lat, lon)
+    if cached_data:
+        return cached_data, True
+
+    # Подготовка запроса к OpenWeatherMap
+    params = {
+        'lat': lat,
+        'lon': lon,
+        'appid': OWM_API_KEY,
+        'units': 'metric'
+    }
+
+    app.logger.debug(
+        "Preparing OWM API request %s", request_id,
+        extra={'api_params': params}
+    )
+
+    # Отправка запроса с таймаутом
+    api_start = time.perf_counter()
+    try:
+        response = http_session.get(OWM_API_URL, params=params, timeout=10)
+    except requests.RequestException as e:
+        app.logger.error(f"OWM API request failed in request {request_id}: {e}")
+        raise WeatherAPIError(None, 'OpenWeatherMap is unavailable') from e
+    api_duration = time.perf_counter() - api_start
+
+    # Тело успешного ответа разбирается один раз и для лога, и для расчета
+    data = None
+    if response.status_code == 200:
+        try:
+            data = json_loads(response.content)
+        except ValueError:
+            pass
+
+    # Логирование взаимодействия с API
+    log_owm_interaction(OWM_API_URL, params, response.status_code, data, api_duration)
+
+    if response.status_code != 200:
+        app.logger.error(
+            f"OWM API error in request {request_id}",
+            extra={
+                'status_code': response.status_code,
+                'response': response.text
+            }
+        )
+        # Тело ошибки может быть не JSON (например, HTML от прокси)
+        try:
+            message = json_loads(response.content).get('message')
+        except (ValueError, AttributeError):
+            message = None
+        raise WeatherAPIError(response.status_code, message or 'Unknown error')
+
+    if not isinstance(data, dict) or 'main' not in data:
+        app.logger.error(f"Invalid OWM API response in request {request_id}")
+        raise WeatherAPIError(response.status_code, 'Invalid response from OpenWeatherMap')
+
+    set_cached_weather(lat, lon, data)
+    return data, False
+
+
+def params_in_range(lat: float, lon: float, room_temp: float) -> bool:
+    """Проверка диапазонов координат и комнатной температуры"""
+    # Квадраты вместо abs(): умножение дешевле вызова функции.
+    # Сравнения записаны как "<=", чтобы NaN тоже отклонялся
+    return lat * lat <= 8100.0 and lon * lon <= 32400.0 and 10.0 <= room_temp <= 40.0
+
+
 @app.route('/get_humidity_info', methods=['GET'])
 @limiter.limit("10 per minute")  # Специальный лимит для этого эндпоинта
 def get_humidity_info():
-    start_time = time.time()
+    start_time = time.perf_counter()
     request_id = f"req-{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}"
 
     app.logger.info(
         f"Incoming request {request_id} from {request.remote_addr}",
-        extra={'request_args': dict(request.args)}
+        extra={'request_args': request.args}
     )
 
     # Получаем параметры запроса
-    lat = request.args.get('lat', type=float)
-    lon = request.args.get('lon', type=float)
-
-
-    room_temp = request.args.get('room_temp', default=22.0, type=float)  # Значение по умолчанию 22°C
-
-    if not lat or not lon:
-        app.logger.warning(f"Bad request {request_id}: missing coordinates")
+    args = request.args
+    try:
+        lat = float(args['lat'])
+        lon = float(args['lon'])
+        room_temp = float(args.get('room_temp', 22.0))  # Значение по умолчанию 22°C
+    except (KeyError, ValueError):
+        app.logger.warning(f"Bad request {request_id}: missing or invalid parameters")
         return jsonify({
-            'error': 'Необходимо указать координаты lat и lon',
+            'error': 'Необходимо указать координаты lat и lon, room_temp должна быть числом',
             'request_id': request_id
         }), 400
 
+    if not params_in_range(lat, lon, room_temp):
+        app.logger.warning(f"Bad request {request_id}: parameters out of range")
+        return jsonify({
+            'error': 'Допустимые значения: lat от -90 до 90, lon от -180 до 180, '
+                     'room_temp от 10 до 40',
+            'request_id': request_id
+        }), 400
 
     try:
-        cached_data = get_cached_weather(lat, lon)
-
-        if cached_data:
-            data = cached_data
-            from_cache = True
-        else:
-            # Подготовка запроса к OpenWeatherMap
-            params = {
-                'lat': lat,
-                'lon': lon,
-                'appid': OWM_API_KEY,
-                'units': 'metric'
-            }
-
-            app.logger.debug(
-                f"Preparing OWM API request {request_id}",
-                extra={'api_params': params}
-            )
-
-            # Отправка запроса с таймаутом
-            api_start = time.time()
-            response = requests.get(OWM_API_URL, params=params, timeout=10)
-            api_duration = time.time() - api_start
-
-            # Логирование взаимодействия с API
-            log_owm_interaction(OWM_API_URL, params, response, api_duration)
-
-            if response.status_code != 200:
-                app.logger.error(
-                    f"OWM API error in request {request_id}",
-                    extra={
-                        'status_code': response.status_code,
-                        'response': response.text
-                    }
-                )
-                return jsonify({
-                    'error': 'Ошибка при получении данных о погоде',
-                    'api_error': response.json().get('message', 'Unknown error'),
-                    'request_id': request_id
-                }), 502
-
-            data = response.json()
-            set_cached_weather(lat, lon, data)
-            from_cache = False
+        try:
+            data, from_cache = fetch_weather(lat, lon, request_id)
+        except WeatherAPIError as e:
+            return jsonify({
+                'error': 'Ошибка при получении данных о погоде',
+                'api_error': e.message,
+                'request_id': request_id
+            }), 502
 
         # После получения данных о погоде:
         temp_c = data['main']['temp']
         relative_humidity = data['main']['humidity']
         location = data.get('name', 'Unknown location')
 
-        # Расчет абсолютной влажности
-        abs_humidity = calculate_absolute_humidity(temp_c, relative_humidity)
+        # Расчет абсолютной влажности и относительной влажности для комнатной температуры
+        humidity = compute_humidity(temp_c, relative_humidity, room_temp)
 
-        if abs_humidity is None:
+        if humidity is None:
             app.logger.error(f"Calculation failed for request {request_id}")
             return jsonify({
                 'error': 'Не удалось рассчитать абсолютную влажность',
                 'request_id': request_id
             }), 500
 
-        # Расчет относительной влажности для комнатной температуры
-        room_rh = calculate_relative_humidity_for_room(abs_humidity, room_temp)
+        abs_humidity, room_rh = humidity
 
-        total_duration = time.time() - start_time
+        total_duration = time.perf_counter() - start_time
 
         result = {
             'request_id': request_id,
@@ -324,7 +591,7 @@ def get_humidity_info():
                 'used_cache': from_cache,
                 'cache_expires': (datetime.now() + CACHE_TTL).isoformat()
                 if not from_cache else None,
-                'cache_ttl_hours': CACHE_TTL.total_seconds() / 3600
+                'cache_ttl_hours': CACHE_TTL_HOURS
             }
         }
 
@@ -340,9 +607,137 @@ def get_humidity_info():
         }), 500
 
 
-if __name__ == '__main__':
-    setup_logging()
-    init_cache()
-    clean_expired_cache()
+def _batch_cost():
+    """Стоимость пакетного запроса для лимитера: число точек в теле запроса"""
+    points = request.get_json(silent=True)
+    # Некорректный пакет отклоняется с 400 и списывает одну единицу, а не весь лимит
+    return len(points) if isinstance(points, list) and 0 < len(points) <= MAX_BATCH_SIZE else 1
+
+
+def _fetch_point(lat: float, lon: float, request_id: str):
+    """Погода для одной точки пакета: (data, from_cache) или WeatherAPIError"""
+    try:
+        return fetch_weather(lat, lon, request_id)
+    except WeatherAPIError as e:
+        return e
+
+
+@app.route('/get_humidity_info_batch', methods=['POST'])
+@limiter.limit("10 per minute", cost=_batch_cost)  # Одна точка пакета = один запрос
+def get_humidity_info_batch():
+    """
+    Пакетный расчет влажности для нескольких точек
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    Тело запроса - JSON-массив объектов {"lat": ..., "lon": ..., "room_temp": ...},
+    room_temp необязателен (по умолчанию 22°C)
+    """
+    start_time = time.perf_counter()
+    request_id = f"req-{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}"
+
+    app.logger.info(f"Incoming batch request {request_id} from {request.remote_addr}")
+
+    points = request.get_json(silent=True)
+    if not isinstance(points, list) or not 0 < len(points) <= MAX_BATCH_SIZE:
+        app.logger.warning(f"Bad request {request_id}: invalid batch body")
+        return jsonify({
+            'error': f'Тело запроса должно быть JSON-массивом из 1-{MAX_BATCH_SIZE} точек',
+            'request_id': request_id
+        }), 400
+
+    try:
+        parsed = [
+            (float(p['lat']), float(p['lon']), float(p.get('room_temp', 22.0)))
+            for p in points
+        ]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        app.logger.warning(f"Bad request {request_id}: missing or invalid parameters")
+        return jsonify({
+            'error': 'Каждая точка должна содержать координаты lat и lon, '
+                     'room_temp должна быть числом',
+            'request_id': request_id
+        }), 400
+
+    if not all(params_in_range(lat, lon, room_temp) for lat, lon, room_temp in parsed):
+        app.logger.warning(f"Bad request {request_id}: parameters out of range")
+        return jsonify({
+            'error': 'Допустимые значения: lat от -90 до 90, lon от -180 до 180, '
+                     'room_temp от 10 до 40',
+            'request_id': request_id
+        }), 400
+
+    try:
+        results = []
+        # Точки с полученными данными о погоде и входные массивы для векторного расчета
+        ok_items, temps, humidities, room_temps = [], [], [], []
+
+        # Промахи кэша по разным точкам ждут ответа OWM параллельно. Пул создается
+        # на запрос, чтобы зависший OWM не занимал потоки других клиентов
+        # (под gevent-воркером потоки - гринлеты)
+        with ThreadPoolExecutor(max_workers=len(parsed), thread_name_prefix='owm-fetch') as pool:
+            fetched = list(pool.map(
+                lambda point: _fetch_point(point[0], point[1], request_id), parsed
+            ))
+
+        for (lat, lon, room_temp), weather in zip(parsed, fetched):
+            item = {'coordinates': {'lat': lat, 'lon': lon}}
+            results.append(item)
+
+            if isinstance(weather, WeatherAPIError):
+                item['error'] = 'Ошибка при получении данных о погоде'
+                item['api_error'] = weather.message
+                continue
+
+            data, from_cache = weather
+            item['location'] = data.get('name', 'Unknown location')
+            item['used_cache'] = from_cache
+            ok_items.append(item)
+            temps.append(data['main']['temp'])
+            humidities.append(data['main']['humidity'])
+            room_temps.append(room_temp)
+
+        # Как и в одиночном расчете, комнатная RH считается от округленной AH
+        abs_humidity = np.round(_ah_kernel(
+            np.array(temps, dtype=np.float64), np.array(humidities, dtype=np.float64)
+        ), 2)
+        room_rh = np.round(_rh_room_kernel(
+            abs_humidity, np.array(room_temps, dtype=np.float64)
+        ), 1)
+
+        for i, item in enumerate(ok_items):
+            item['outdoor_weather'] = {
+                'temperature_c': temps[i],
+                'relative_humidity': humidities[i],
+                'absolute_humidity_g_m3': float(abs_humidity[i])
+            }
+            item['indoor_estimation'] = {
+                'room_temperature_c': room_temps[i],
+                'estimated_relative_humidity': float(room_rh[i]),
+                'absolute_humidity_g_m3': float(abs_humidity[i])
+            }
+
+        app.logger.info(f"Successful batch response for request {request_id}")
+        return jsonify({
+            'request_id': request_id,
+            'results': results,
+            'processing_time_sec': time.perf_counter() - start_time,
+            'data_source': 'OpenWeatherMap'
+        })
+
+    except Exception as e:
+        app.logger.error(f"Unexpected error in request {request_id}", exc_info=True)
+        return jsonify({
+            'error': 'Внутренняя ошибка сервера',
+            'request_id': request_id,
+            'details': str(e)
+        }), 500
+
+
+# Инициализация при импорте: одинаково для `python main.py` и `gunicorn main:app`
+setup_logging()
+init_cache()
+threading.Thread(target=_cache_writer, name='cache-writer', daemon=True).start()
+
+
+if __name__ == '__main__':
+    # Локальный запуск; в продакшене: gunicorn main:app (настройки в gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file